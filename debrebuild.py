@@ -21,20 +21,30 @@
 import os
 import sys
 import re
-import requests
+import urllib.parse
 import tempfile
+import secrets
 import json
+import time
+import datetime
+import fcntl
 import subprocess
+import multiprocessing
+import threading
+import queue
+import atexit
+import concurrent.futures
 import shutil
 import argparse
 import logging
-import apt
-import apt_pkg
 
 from debian.deb822 import Deb822
-from dateutil.parser import parse as parsedate
+from email.utils import parsedate_to_datetime
 from libs.openpgp import OpenPGPEnvironment, OpenPGPException
 
+# apt, apt_pkg and requests are slow to import. They are imported where
+# needed so that --help and invalid arguments do not wait for them.
+
 logger = logging.getLogger(__name__)
 console_handler = logging.StreamHandler(sys.stderr)
 logger.addHandler(console_handler)
@@ -50,6 +60,141 @@ DEBIAN_VERSION = {
     "12": "bookworm"
 }
 
+# Architecture field values which are not a real architecture
+RESERVED_ARCHITECTURES = frozenset(("source", "all"))
+
+# Buildinfo fields stored as is, mapped to their BuildInfo attribute
+BUILDINFO_SIMPLE_FIELDS = {
+    "Source": "source",
+    "Version": "version",
+    "Build-Path": "build_path",
+    "Build-Architecture": "build_arch",
+    "Build-Date": "build_date",
+    "Host-Architecture": "host_arch",
+}
+
+# DEB_BUILD_OPTIONS="parallel=8"
+_ENV_RE = re.compile(r'\A[^=](.+?)="(.*)"')
+
+# Native architecture of the builder, see read_host_architecture()
+HOST_ARCHITECTURE = None
+
+# API queried for package and binary information by default
+DEFAULT_SNAPSHOT_URL = "http://snapshot.debian.org"
+
+# Number of concurrent queries to snapshot.debian.org
+SNAPSHOT_QUERY_WORKERS = 16
+
+# Seconds during which a not found answer of snapshot.debian.org is reused
+SNAPSHOT_NOTFOUND_CACHE_TTL = 3600
+
+
+def get_cache_dir():
+    cache_home = os.environ.get(
+        'XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+    return os.path.join(cache_home, 'debrebuild')
+
+
+def read_host_architecture():
+    # It is read once before any apt.Cache(rootdir=...) overrides
+    # APT::Architecture in the global config.
+    global HOST_ARCHITECTURE
+    if HOST_ARCHITECTURE is None:
+        import apt_pkg
+        if "APT" not in apt_pkg.config:
+            apt_pkg.init_config()
+        HOST_ARCHITECTURE = apt_pkg.config.find("APT::Architecture")
+    return HOST_ARCHITECTURE
+
+
+def get_session(proxy=None):
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=SNAPSHOT_QUERY_WORKERS,
+        pool_maxsize=SNAPSHOT_QUERY_WORKERS,
+        max_retries=Retry(total=5, backoff_factor=0.3,
+                          status_forcelist=[502, 503, 504],
+                          raise_on_status=False))
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.proxies = {
+            "http": proxy,
+            "https": proxy
+        }
+    return session
+
+
+def get_snapshot_timestamp(first_seen):
+    # snapshot.debian.org already provides dates like 20200319T204637Z
+    if len(first_seen) == 16 and first_seen.endswith('Z'):
+        return first_seen
+    try:
+        date = datetime.datetime.fromisoformat(
+            first_seen.replace('Z', '+00:00'))
+    except ValueError as e:
+        raise RebuilderException("Cannot parse 'first_seen': %s" % e)
+    # snapshot timestamps are in UTC, dates without offset are taken as such
+    if date.tzinfo is not None:
+        date = date.astimezone(datetime.timezone.utc)
+    return date.strftime("%Y%m%dT%H%M%SZ")
+
+
+def _fast_rmtree(path):
+    # 'rm -rf' removes large trees much faster than shutil.rmtree().
+    # DEBREBUILD_FASTRM=shutil forces the pure Python implementation.
+    if os.environ.get('DEBREBUILD_FASTRM', 'rm') == 'rm':
+        try:
+            subprocess.run(["rm", "-rf", "--", path], check=True)
+            return
+        except (FileNotFoundError, subprocess.CalledProcessError):
+            pass
+    # Where supported (shutil.rmtree.avoids_symlink_attacks), this walks
+    # the tree with os.scandir() and unlinks entries relative to their
+    # directory file descriptor, without resolving full paths.
+    shutil.rmtree(path)
+
+
+class _AsyncDeleter:
+    """
+        Removes directories in a background thread. Pending removals are
+        waited for at interpreter exit.
+    """
+    def __init__(self):
+        self.reset()
+        # threads do not survive fork(), child processes start over
+        os.register_at_fork(after_in_child=self.reset)
+
+    def reset(self):
+        self.queue = queue.Queue()
+        self.thread = None
+
+    def submit(self, path):
+        if not self.thread:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+            atexit.register(self.wait)
+        self.queue.put(path)
+
+    def wait(self):
+        self.queue.join()
+
+    def run(self):
+        while True:
+            path = self.queue.get()
+            try:
+                _fast_rmtree(path)
+            except OSError as e:
+                logger.error("Cannot remove {}: {}".format(path, str(e)))
+            finally:
+                self.queue.task_done()
+
+
+_deleter = _AsyncDeleter()
+
 
 class PackageException(Exception):
     pass
@@ -65,14 +210,14 @@ class RebuilderException(Exception):
 
 def parsePkgBuildDepend(pkg):
     # g++-mingw-w64-x86-64 (= 8.3.0-26+21.5+b1)
-    parsed = re.match(r'^(.*) \(= (.*)\),*', pkg)
-    if parsed:
-        name = parsed.group(1).strip()
-        version = parsed.group(2).strip()
-        return Package(name, version)
+    name, sep, version = pkg.strip().rstrip(',').partition(' (= ')
+    if sep and version.endswith(')'):
+        return Package(name.strip(), version[:-1].strip())
 
 
 class Package:
+    __slots__ = ['name', 'version', 'architecture', 'first_seen', 'hash']
+
     def __init__(self, name, version, architecture=None):
         self.name = name
         self.version = version
@@ -118,60 +263,48 @@ class BuildInfo:
 
         self.required_timestamps = []
         self.debian_suite = None
+        self.build_timestamp = None
 
         if not os.path.exists(self.orig_file):
             raise BuildInfoException(
                 "Cannot find buildinfo file: {}".format(self.orig_file))
 
         with open(self.orig_file) as fd:
-            for paragraph in Deb822.iter_paragraphs(fd.read()):
-                for item in paragraph.items():
-                    if item[0] == 'Source':
-                        self.source = item[1]
-                    if item[0] == 'Architecture':
-                        self.architecture = item[1].split()
-                    if item[0] == 'Binary':
-                        self.binary = item[1].split()
-                    if item[0] == 'Version':
-                        self.version = item[1]
-                    if item[0] == 'Build-Path':
-                        self.build_path = item[1]
-                    if item[0] == 'Build-Architecture':
-                        self.build_arch = item[1]
-                    if item[0] == 'Build-Date':
-                        self.build_date = item[1]
-                    if item[0] == 'Host-Architecture':
-                        self.host_arch = item[1]
-                    if item[0].startswith('Checksums-'):
-                        alg = item[0].replace('Checksums-', '').lower()
-                        for line in item[1].lstrip('\n').split('\n'):
-                            parsed_line = line.split()
-                            if not self.checksums.get(parsed_line[2], {}):
-                                self.checksums[parsed_line[2]] = {}
-                            self.checksums[parsed_line[2]].update({
-                                "size": parsed_line[1],
-                                alg: parsed_line[0],
-                            })
-                    if item[0] == 'Installed-Build-Depends':
-                        for pkg in item[1].lstrip('\n').split('\n'):
+            for paragraph in Deb822.iter_paragraphs(
+                    fd, use_apt_pkg=False):
+                for field, value in paragraph.items():
+                    if field in BUILDINFO_SIMPLE_FIELDS:
+                        setattr(self, BUILDINFO_SIMPLE_FIELDS[field], value)
+                    elif field == 'Installed-Build-Depends':
+                        for pkg in value.lstrip('\n').split('\n'):
                             parsed_pkg = parsePkgBuildDepend(pkg)
                             if not parsed_pkg:
                                 raise BuildInfoException(
                                     "Cannot parse package: %s" % pkg)
                             self.build_depends.append(parsed_pkg)
-                    if item[0] == 'Environment':
-                        for line in item[1].lstrip('\n').split('\n'):
-                            parsed_line = re.match(r'^[^=](.*)="(.*)"', line)
+                    elif field.startswith('Checksums-'):
+                        alg = field.replace('Checksums-', '').lower()
+                        for line in value.split('\n'):
+                            if not line:
+                                continue
+                            checksum, size, name = line.split()
+                            self.checksums.setdefault(
+                                name, {"size": size})[alg] = checksum
+                    elif field == 'Environment':
+                        for line in value.lstrip('\n').split('\n'):
+                            parsed_line = _ENV_RE.match(line)
                             if parsed_line:
                                 self.env[parsed_line.group(1).strip()] = \
                                     parsed_line.group(2).strip()
+                    elif field == 'Architecture':
+                        self.architecture = value.split()
+                    elif field == 'Binary':
+                        self.binary = value.split()
 
-        self.build_source = len(
-            [arch for arch in self.architecture if arch == "source"]) == 1
-        self.build_archall = len(
-            [arch for arch in self.architecture if arch == "all"]) == 1
+        self.build_source = self.architecture.count("source") == 1
+        self.build_archall = self.architecture.count("all") == 1
         self.architecture = [arch for arch in self.architecture if
-                             arch != "source" and arch != "all"]
+                             arch not in RESERVED_ARCHITECTURES]
 
         if len(self.architecture) > 1:
             raise BuildInfoException(
@@ -184,28 +317,36 @@ class BuildInfo:
             self.host_arch = self.build_arch
         if not self.build_path:
             self.build_path = "/build/{}-{}".format(
-                self.source, next(tempfile._get_candidate_names()))
+                self.source, secrets.token_hex(4))
+
+        self.build_depends_by_name = {
+            pkg.name: pkg for pkg in self.build_depends}
 
     def get_debian_suite(self):
         if not self.debian_suite:
-            for pkg in self.get_build_depends():
-                if str(pkg.name) == "base-files":
-                    try:
-                        self.debian_suite = DEBIAN_VERSION[pkg.version]
-                    except KeyError:
-                        raise BuildInfoException(
-                            "Cannot determine Debian version")
+            pkg = self.build_depends_by_name.get("base-files")
+            if pkg:
+                self.debian_suite = DEBIAN_VERSION.get(pkg.version)
+            if not self.debian_suite:
+                raise BuildInfoException("Cannot determine Debian version")
         return self.debian_suite
 
     def get_build_depends(self):
         return self.build_depends
 
     def get_build_date(self):
-        try:
-            return parsedate(self.build_date).strftime(
-                "%Y%m%dT%H%M%SZ")
-        except ValueError as e:
-            raise RebuilderException("Cannot parse 'Build-Date': %s" % e)
+        if not self.build_timestamp:
+            try:
+                date = parsedate_to_datetime(self.build_date)
+            except (TypeError, ValueError) as e:
+                raise RebuilderException(
+                    "Cannot parse 'Build-Date': %s" % e)
+            # dpkg writes the local offset of the builder, "-0000" gives
+            # a date without offset which is taken as UTC
+            if date.tzinfo is not None:
+                date = date.astimezone(datetime.timezone.utc)
+            self.build_timestamp = date.strftime("%Y%m%dT%H%M%SZ")
+        return self.build_timestamp
 
 
 class Rebuilder:
@@ -215,7 +356,19 @@ class Rebuilder:
                  gpg_sign_keyid=None,
                  gpg_verify=False,
                  gpg_verify_key=None,
-                 proxy=None):
+                 gpg_env=None,
+                 proxy=None,
+                 cache_dir=None,
+                 keep_aptcache=False,
+                 session=None):
+        import requests
+        import urllib3
+
+        if gpg_verify and not (gpg_env or gpg_verify_key):
+            raise RebuilderException(
+                "Cannot verify buildinfo signature without GPG keyring provided")
+
+        read_host_architecture()
         self.buildinfo = None
         self.snapshot_url = snapshot_url
         self.base_mirror = base_mirror
@@ -223,38 +376,72 @@ class Rebuilder:
         self.extra_repository_keys = extra_repository_keys
         self.gpg_sign_keyid = gpg_sign_keyid
         self.proxy = proxy
-        self.session = requests.Session()
-        self.session.proxies = {
-                "http:": self.proxy,
-                "https": self.proxy
-            }
+        # A session shared between rebuilds keeps its connections alive
+        self.session = session or get_session(proxy)
 
         self.tempaptdir = None
         self.tempaptcache = None
+        self.aptcache_lock = None
+        # snapshot sources already fetched in a persistent APT root
+        self.updated_snapshot_sources = set()
         self.required_timestamp_sources = []
+        self.sources_list = None
 
         self.tmpdir = os.environ.get('TMPDIR', '/tmp')
 
+        # The APT root is kept across runs only on request as its
+        # snapshot indexes are never pruned
+        self.persistent_aptcache = keep_aptcache
+        self.cache_dir = cache_dir or get_cache_dir()
+
+        # snapshot.debian.org answers are cached on disk without expiration.
+        # A known file never changes but more architectures of a package
+        # may be imported later, see get_cached_json().
+        self.snapshot_cache_dir = os.path.join(
+            self.cache_dir, urllib.parse.urlparse(snapshot_url).netloc)
+        self.cached_responses = {}
+
+        temp_buildinfo_file = None
         if buildinfo_file.startswith('http://') or \
                 buildinfo_file.startswith('https://'):
             try:
-                resp = self.session.get(buildinfo_file)
-                resp.raise_for_status()
-                # We store remote buildinfo in a temporary file
-                handle, buildinfo_file = tempfile.mkstemp(
-                    prefix="buildinfo-", dir=self.tmpdir)
-                with open(handle, 'w') as fd:
-                    fd.write(resp.text)
-            except (requests.exceptions.ConnectionError,
-                    requests.exceptions.HTTPError) as e:
+                with self.session.get(buildinfo_file, stream=True) as resp:
+                    resp.raise_for_status()
+                    # We store remote buildinfo in a temporary file
+                    handle, temp_buildinfo_file = tempfile.mkstemp(
+                        prefix="buildinfo-", dir=self.tmpdir)
+                    # let urllib3 undo any transport compression
+                    resp.raw.decode_content = True
+                    with os.fdopen(handle, 'wb') as fd:
+                        shutil.copyfileobj(resp.raw, fd, 65536)
+            # reading resp.raw raises urllib3 errors as is
+            except (requests.exceptions.RequestException,
+                    urllib3.exceptions.HTTPError) as e:
+                if temp_buildinfo_file:
+                    os.remove(temp_buildinfo_file)
                 raise RebuilderException("Cannot get buildinfo: {}".format(e))
+            buildinfo_file = temp_buildinfo_file
         else:
             buildinfo_file = realpath(buildinfo_file)
 
-        if gpg_verify and gpg_verify_key:
-            gpg_env = OpenPGPEnvironment()
+        try:
+            self.load_buildinfo(
+                buildinfo_file, gpg_verify, gpg_verify_key, gpg_env)
+        finally:
+            if temp_buildinfo_file:
+                os.remove(temp_buildinfo_file)
+
+    def load_buildinfo(self, buildinfo_file, gpg_verify=False,
+                       gpg_verify_key=None, gpg_env=None):
+        if gpg_verify:
+            # A GPG environment shared between several rebuilds already
+            # holds the verification keys and is closed by its owner
+            own_gpg_env = gpg_env is None
+            if own_gpg_env:
+                gpg_env = OpenPGPEnvironment()
             try:
-                gpg_env.import_key(gpg_verify_key)
+                if own_gpg_env:
+                    gpg_env.import_key(gpg_verify_key)
                 data = gpg_env.verify_file(buildinfo_file)
                 logger.info(
                     "GPG ({}): OK".format(data.primary_key_fingerprint))
@@ -262,12 +449,10 @@ class Rebuilder:
                 raise RebuilderException(
                     "Failed to verify buildinfo: {}".format(str(e)))
             finally:
-                gpg_env.close()
+                if own_gpg_env:
+                    gpg_env.close()
 
         self.buildinfo = BuildInfo(buildinfo_file)
-        if buildinfo_file.startswith(
-                os.path.join(self.tmpdir, 'buildinfo-')):
-            os.remove(buildinfo_file)
 
     def get_env(self):
         env = []
@@ -279,7 +464,58 @@ class Rebuilder:
         resp = self.session.get(url)
         return resp
 
+    def get_cached_json(self, category, key, url, usable=None):
+        """
+            Returns the JSON answer of url, cached under category/key.
+            A cached answer for which usable(data) is false is fetched
+            again, and only usable answers are written to disk.
+        """
+        cache_file = os.path.join(
+            self.snapshot_cache_dir, category, "{}.json".format(key))
+        data = self.cached_responses.get(cache_file)
+        if data is None:
+            try:
+                with open(cache_file) as fd:
+                    data = json.load(fd)
+            except (OSError, json.decoder.JSONDecodeError):
+                pass
+
+        if data is None or (usable and not usable(data)):
+            # Unknown packages may still be imported later, so
+            # not found answers are only kept for a while
+            notfound_file = cache_file + ".notfound"
+            try:
+                if time.time() - os.stat(notfound_file).st_mtime < \
+                        SNAPSHOT_NOTFOUND_CACHE_TTL:
+                    raise RebuilderException("Not found: {}".format(url))
+            except FileNotFoundError:
+                pass
+            resp = self.get_response(url)
+            if resp.status_code == 404:
+                self.write_cache_file(notfound_file, None)
+                raise RebuilderException("Not found: {}".format(url))
+            data = resp.json()
+            if resp.ok and (not usable or usable(data)):
+                self.write_cache_file(cache_file, data)
+        self.cached_responses[cache_file] = data
+        return data
+
+    @staticmethod
+    def write_cache_file(cache_file, data):
+        try:
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            with tempfile.NamedTemporaryFile(
+                    'w', dir=os.path.dirname(cache_file),
+                    suffix='.tmp', delete=False) as fd:
+                json.dump(data, fd)
+            os.replace(fd.name, cache_file)
+        except OSError as e:
+            logger.debug("Cannot write cache file {}: {}".format(
+                cache_file, str(e)))
+
     def get_sources_list(self):
+        if self.sources_list:
+            return self.sources_list
         sources_list = []
         url = "{}/{}".format(self.base_mirror, self.buildinfo.get_build_date())
         base_dist = self.buildinfo.get_debian_suite()
@@ -298,14 +534,16 @@ class Rebuilder:
             for repo_file in self.extra_repository_files:
                 try:
                     with open(repo_file) as fd:
-                        for line in fd:
-                            if not line.startswith('#') and \
-                                    not line.startswith('\n'):
-                                sources_list.append(line.rstrip('\n'))
+                        lines = fd.read().splitlines()
+                    sources_list.extend(
+                        line for line in lines
+                        if line and not line.startswith('#'))
                 except FileNotFoundError:
                     raise RebuilderException(
                         "Cannot find repository file: {}".format(repo_file))
 
+        # checking the snapshot Release file is done once per run
+        self.sources_list = sources_list
         return sources_list
 
     def get_build_depends_timestamps(self):
@@ -314,11 +552,21 @@ class Rebuilder:
             where pkgs is a list of packages living there
         """
         required_timestamps = {}
+        # get_bin_date only updates the package given as argument
+        # so the queries can run concurrently
+        pkgs = [pkg for pkg in self.buildinfo.get_build_depends()
+                if not pkg.first_seen]
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=SNAPSHOT_QUERY_WORKERS) as executor:
+            try:
+                list(executor.map(self.get_bin_date, pkgs))
+            except BaseException:
+                # report the failure without waiting for queued queries
+                executor.shutdown(wait=True, cancel_futures=True)
+                raise
         for pkg in self.buildinfo.get_build_depends():
-            if not pkg.first_seen:
-                self.get_bin_date(pkg)
             required_timestamps.setdefault(
-                parsedate(pkg.first_seen).strftime("%Y%m%dT%H%M%SZ"), []).append(pkg)
+                get_snapshot_timestamp(pkg.first_seen), []).append(pkg)
         # sort by the number of packages found there, convert to list of tuples
         required_timestamps = sorted(required_timestamps.items(),
                 key=lambda x: len(x[1]), reverse=True)
@@ -345,10 +593,11 @@ class Rebuilder:
         json_url = "/mr/package/{}/{}/srcfiles?fileinfo=1".format(
             srcpkgname, srcpkgver)
         json_url = self.snapshot_url + json_url
-        resp = self.get_response(json_url)
         logger.debug("Source URL: {}".format(json_url))
         try:
-            data = resp.json()
+            data = self.get_cached_json(
+                "srcfiles", "{}_{}".format(srcpkgname, srcpkgver), json_url,
+                usable=lambda data: bool(data.get('result')))
         except json.decoder.JSONDecodeError:
             raise RebuilderException(
                 "Cannot parse response for source: {}".format(self.buildinfo.source))
@@ -377,10 +626,19 @@ class Rebuilder:
         json_url = "/mr/binary/{}/{}/binfiles?fileinfo=1".format(
             pkgname, pkgver)
         json_url = self.snapshot_url + json_url
-        resp = self.get_response(json_url)
         logger.debug("Binary URL: {}".format(json_url))
+        # The answer lists the architectures imported so far, it has to
+        # be fetched again while the one needed is missing
+        if pkgarch:
+            wanted_archs = (pkgarch,)
+        else:
+            wanted_archs = (self.buildinfo.build_arch, "all")
         try:
-            data = resp.json()
+            data = self.get_cached_json(
+                "binfiles", "{}_{}".format(pkgname, pkgver), json_url,
+                usable=lambda data: any(
+                    result.get('architecture') in wanted_archs
+                    for result in data.get('result', [])))
         except json.decoder.JSONDecodeError:
             raise RebuilderException(
                 "Cannot parse response for package: {}".format(package.name))
@@ -425,38 +683,51 @@ class Rebuilder:
         return package.first_seen
 
     def find_build_dependencies(self):
-        notfound_packages = self.buildinfo.build_depends[:]
+        # Package objects hash by identity which is stable while
+        # get_bin_date() fills their architecture
+        notfound_packages = set(self.buildinfo.build_depends)
         temp_sources_list = self.tempaptdir + '/etc/apt/sources.list'
-        with open(temp_sources_list, "a") as fd:
-            for timestamp_source, pkgs in self.get_sources_list_from_timestamp():
-                if not notfound_packages:
-                    break
-                if not any(pkg in notfound_packages for pkg in pkgs):
-                    logger.info("Skipping snapshot: {}".format(timestamp_source))
-                    continue
-                logger.info("Remaining packages to be found: {}".format(
-                    len(notfound_packages)))
-                self.required_timestamp_sources.append(timestamp_source)
-                logger.debug("Timestamp source ({} packages): {}".format(len(pkgs), timestamp_source))
+        # The first snapshot is loaded along with the base sources.list.
+        # Packages still missing afterwards are provided neither by the
+        # base sources nor by previously added snapshots, so every next
+        # cache only has to load the snapshot being added.
+        sources_list_mode = "a"
+        for timestamp_source, pkgs in self.get_sources_list_from_timestamp():
+            if not notfound_packages:
+                break
+            if notfound_packages.isdisjoint(pkgs):
+                logger.info("Skipping snapshot: {}".format(timestamp_source))
+                continue
+            logger.info("Remaining packages to be found: {}".format(
+                len(notfound_packages)))
+            self.required_timestamp_sources.append(timestamp_source)
+            logger.debug("Timestamp source ({} packages): {}".format(len(pkgs), timestamp_source))
+            with open(temp_sources_list, sources_list_mode) as fd:
                 fd.write("\n{}".format(timestamp_source))
-                fd.flush()
 
+            # Snapshots never change so a snapshot alone in sources.list
+            # is not fetched again if a previous run using the same
+            # persistent APT root already did it
+            if sources_list_mode == "a" or \
+                    timestamp_source not in self.updated_snapshot_sources:
                 # provides sources.list explicitly, otherwise `update()`
                 # doesn't reload it until the next `open()`
                 self.tempaptcache.update(sources_list=temp_sources_list)
-                self.tempaptcache.open()
-
-                for notfound_pkg in notfound_packages[:]:
-                    pkg = self.tempaptcache.get("{}:{}".format(
-                        notfound_pkg.name, notfound_pkg.architecture))
-                    if pkg and pkg.versions.get(notfound_pkg.version):
-                        notfound_packages.remove(notfound_pkg)
-                    # else:
-                    #     logger.debug("{} {} {}".format(
-                    #         notfound_pkg.name, notfound_pkg.version,
-                    #         notfound_pkg.architecture))
+                self.add_updated_snapshot_source(timestamp_source)
+            self.tempaptcache.open()
+            sources_list_mode = "w"
+
+            for notfound_pkg in list(notfound_packages):
+                pkg = self.tempaptcache.get("{}:{}".format(
+                    notfound_pkg.name, notfound_pkg.architecture))
+                if pkg and pkg.versions.get(notfound_pkg.version):
+                    notfound_packages.discard(notfound_pkg)
+                # else:
+                #     logger.debug("{} {} {}".format(
+                #         notfound_pkg.name, notfound_pkg.version,
+                #         notfound_pkg.architecture))
 
-                self.tempaptcache.close()
+            self.tempaptcache.close()
 
         if notfound_packages:
             for notfound_pkg in notfound_packages:
@@ -464,9 +735,45 @@ class Rebuilder:
             raise RebuilderException("Cannot locate the following packages via "
                                      "snapshots or the current repo/mirror")
 
+    def add_updated_snapshot_source(self, timestamp_source):
+        if not self.persistent_aptcache or \
+                timestamp_source in self.updated_snapshot_sources:
+            return
+        self.updated_snapshot_sources.add(timestamp_source)
+        with open(self.tempaptdir + '/updated-snapshots', "a") as fd:
+            fd.write("{}\n".format(timestamp_source))
+
+    def lock_aptcache(self):
+        # Other rebuilds, in this process or not, share the same APT root
+        os.makedirs(self.tempaptdir, exist_ok=True)
+        self.aptcache_lock = open(
+            os.path.join(self.tempaptdir, "debrebuild.lock"), "w")
+        try:
+            fcntl.flock(self.aptcache_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logger.info("Waiting for APT cache lock: {}".format(
+                self.tempaptdir))
+            fcntl.flock(self.aptcache_lock, fcntl.LOCK_EX)
+
+    def unlock_aptcache(self):
+        if self.aptcache_lock:
+            self.aptcache_lock.close()
+            self.aptcache_lock = None
+
     def prepare_aptcache(self):
-        self.tempaptdir = tempfile.mkdtemp(
-            prefix="debrebuild-", dir=self.tmpdir)
+        if self.persistent_aptcache:
+            # Indexes are architecture specific
+            self.tempaptdir = os.path.join(
+                self.cache_dir, "aptroot", self.buildinfo.build_arch)
+            self.lock_aptcache()
+            try:
+                with open(self.tempaptdir + '/updated-snapshots') as fd:
+                    self.updated_snapshot_sources = set(fd.read().splitlines())
+            except FileNotFoundError:
+                pass
+        else:
+            self.tempaptdir = tempfile.mkdtemp(
+                prefix="debrebuild-", dir=self.tmpdir)
 
         # Create apt.conf
         temp_apt_conf = "{}/etc/apt/apt.conf".format(self.tempaptdir)
@@ -477,7 +784,8 @@ class Rebuilder:
             '/etc/apt', '/etc/apt/trusted.gpg.d'
         ]
         for directory in apt_dirs:
-            os.makedirs("{}/{}".format(self.tempaptdir, directory))
+            os.makedirs("{}/{}".format(self.tempaptdir, directory),
+                        exist_ok=True)
 
         with open(temp_apt_conf, "w") as fd:
             apt_conf = """
@@ -497,8 +805,9 @@ Binary::apt-get::Acquire::AllowInsecureRepositories "false";
                 apt_conf += '\nAcquire::http::proxy "{}";\n'.format(self.proxy)
             fd.write(apt_conf)
 
-        with open(temp_sources_list, "w") as fd:
-            fd.write("\n".join(self.get_sources_list()))
+        # Start from an empty sources.list so that initializing the
+        # cache does not parse indexes left by a previous run
+        open(temp_sources_list, "w").close()
 
         keyrings = [
             "/usr/share/keyrings/debian-archive-keyring.gpg",
@@ -506,12 +815,18 @@ Binary::apt-get::Acquire::AllowInsecureRepositories "false";
         ]
         if self.extra_repository_keys:
             keyrings += self.extra_repository_keys
+        # Keys trusted by a previous run must not be kept
+        trusted_dir = "{}/etc/apt/trusted.gpg.d".format(self.tempaptdir)
+        for keyring in os.listdir(trusted_dir):
+            os.remove(os.path.join(trusted_dir, keyring))
         for keyring_src in keyrings:
-            keyring_dst = "{}/etc/apt/trusted.gpg.d/{}".format(
-                self.tempaptdir, os.path.basename(keyring_src))
+            keyring_dst = "{}/{}".format(
+                trusted_dir, os.path.basename(keyring_src))
             os.symlink(keyring_src, keyring_dst)
 
         # Init temporary APT cache
+        import apt
+        import apt_pkg
         try:
             logger.debug("Initialize APT cache")
             self.tempaptcache = apt.Cache(rootdir=self.tempaptdir, memonly=True)
@@ -519,6 +834,9 @@ Binary::apt-get::Acquire::AllowInsecureRepositories "false";
         except (PermissionError, apt_pkg.Error):
             raise RebuilderException("Failed to initialize APT cache")
 
+        with open(temp_sources_list, "w") as fd:
+            fd.write("\n".join(self.get_sources_list()))
+
     def get_apt_build_depends(self):
         apt_build_depends = []
         for pkg in self.buildinfo.get_build_depends():
@@ -550,6 +868,10 @@ Binary::apt-get::Acquire::AllowInsecureRepositories "false";
             build = build_arch
         else:
             build = "binary"
+        suite = self.buildinfo.get_debian_suite()
+        sources_list = self.get_sources_list() + \
+            self.required_timestamp_sources
+        build_dir = os.path.dirname(self.buildinfo.build_path)
         cmd = [
             'env', '-i',
             'PATH=/usr/sbin:/usr/bin:/sbin:/bin',
@@ -589,7 +911,7 @@ Binary::apt-get::Acquire::AllowInsecureRepositories "false";
             '--essential-hook=chroot "$1" sh -c \"{}\"'.format(" && ".join(
                 [
                     'rm /etc/apt/sources.list',
-                    "echo '{}' >> /etc/apt/sources.list".format('\n'.join(self.get_sources_list() + self.required_timestamp_sources)),
+                    "echo '{}' >> /etc/apt/sources.list".format('\n'.join(sources_list)),
                     'apt-get update'
                 ]
             ))
@@ -599,7 +921,7 @@ Binary::apt-get::Acquire::AllowInsecureRepositories "false";
             '--customize-hook=chroot "$1" env --unset=TMPDIR sh -c \"{}\"'.format(" && ".join(
                 [
                     'apt-get source --only-source -d {}={}'.format(self.buildinfo.source, self.buildinfo.version),
-                    'mkdir -p {}'.format(os.path.dirname(self.buildinfo.build_path)),
+                    'mkdir -p {}'.format(build_dir),
                     'dpkg-source --no-check -x /*.dsc {}'.format(self.buildinfo.build_path),
                     'cd {}'.format(self.buildinfo.build_path),
                     'env {} dpkg-buildpackage -uc -a {} --build={}'.format(' '.join(self.get_env()), self.buildinfo.host_arch, build)
@@ -608,8 +930,8 @@ Binary::apt-get::Acquire::AllowInsecureRepositories "false";
         ]
 
         cmd += [
-            '--customize-hook=sync-out {} {}'.format(os.path.dirname(self.buildinfo.build_path), output),
-            self.buildinfo.get_debian_suite(),
+            '--customize-hook=sync-out {} {}'.format(build_dir, output),
+            suite,
             '/dev/null',
             self.get_chroot_basemirror()
         ]
@@ -628,6 +950,13 @@ Binary::apt-get::Acquire::AllowInsecureRepositories "false";
                 "New buildinfo contains a different number of files.")
 
         for f in files:
+            if f not in new_buildinfo.checksums:
+                raise RebuilderException(
+                    "{} is missing from new buildinfo".format(f))
+            # identical entries need no field by field comparison
+            if self.buildinfo.checksums[f] == new_buildinfo.checksums[f]:
+                logger.info("{}: OK".format(f))
+                continue
             for prop in self.buildinfo.checksums[f].keys():
                 if prop == "size":
                     f_size = self.buildinfo.checksums[f]["size"]
@@ -660,14 +989,22 @@ Binary::apt-get::Acquire::AllowInsecureRepositories "false";
 
     @staticmethod
     def get_host_architecture():
-        try:
-            builder_architecture = subprocess.check_output(
-                ["dpkg", "--print-architecture"]).decode('utf8').rstrip('\n')
-        except FileNotFoundError:
+        host_arch = read_host_architecture()
+        if not host_arch:
             raise RebuilderException("Cannot determinate builder host architecture")
-        return builder_architecture
+        return host_arch
 
     def run(self, builder, output, no_checksums_verification=False):
+        import apt
+        import apt_pkg
+        import requests
+
+        if builder not in self.BUILDERS:
+            raise RebuilderException("Unknown builder: {}".format(builder))
+        if self.BUILDERS[builder] and not output:
+            raise RebuilderException(
+                "Output directory is required by builder: {}".format(builder))
+
         # Predict new buildinfo name created by builder
         # Based on dpkg/scripts/dpkg-genbuildinfo.pl
         if self.buildinfo.architecture:
@@ -697,17 +1034,20 @@ Binary::apt-get::Acquire::AllowInsecureRepositories "false";
         except KeyboardInterrupt:
             raise RebuilderException("Interruption")
         finally:
-            if self.tempaptdir and self.tempaptdir.startswith(
-                    os.path.join(self.tmpdir, 'debrebuild-')):
+            self.unlock_aptcache()
+            if self.tempaptdir and not self.persistent_aptcache and \
+                    self.tempaptdir.startswith(
+                        os.path.join(self.tmpdir, 'debrebuild-')):
                 if self.tempaptcache:
                     self.tempaptcache.close()
-                shutil.rmtree(self.tempaptdir)
+                # the build does not need it, remove it meanwhile
+                _deleter.submit(self.tempaptdir)
 
         # Stage 2: Run the actual rebuild of provided buildinfo file
-        if builder == "none":
+        build = self.BUILDERS[builder]
+        if not build:
             return
-        if builder == "mmdebstrap":
-            self.mmdebstrap(output, build_arch)
+        build(self, output, build_arch)
 
         # Stage 3: Everything post-build actions with rebuild artifacts
         new_buildinfo = BuildInfo(realpath(new_buildinfo_file))
@@ -722,6 +1062,12 @@ Binary::apt-get::Acquire::AllowInsecureRepositories "false";
                 raise RebuilderException(msg)
         self.generate_intoto_metadata(output, new_buildinfo)
 
+    # Build backends by name, "none" only locates the build dependencies
+    BUILDERS = {
+        "none": None,
+        "mmdebstrap": mmdebstrap,
+    }
+
 
 def get_args():
     parser = argparse.ArgumentParser(
@@ -732,11 +1078,20 @@ def get_args():
     )
     parser.add_argument(
         "buildinfo",
+        nargs="+",
         help="Input buildinfo file. Local or remote file."
     )
     parser.add_argument(
         "--output",
-        help="Directory for the build artifacts",
+        help="Directory for the build artifacts. With several buildinfo "
+             "files, artifacts go in a sub directory named after each "
+             "buildinfo file.",
+    )
+    parser.add_argument(
+        "--jobs",
+        help="Number of buildinfo files rebuilt in parallel. (default: 1)",
+        type=int,
+        default=1
     )
     parser.add_argument(
         "--builder",
@@ -746,8 +1101,8 @@ def get_args():
     parser.add_argument(
         "--query-url",
         help="API url for querying package and binary information "
-             "(default: http://snapshot.debian.org)",
-        default="http://snapshot.debian.org"
+             "(default: {})".format(DEFAULT_SNAPSHOT_URL),
+        default=DEFAULT_SNAPSHOT_URL
     )
     parser.add_argument(
         "--extra-repository-file",
@@ -778,6 +1133,18 @@ def get_args():
         "--proxy",
         help="Proxy address to use."
     )
+    parser.add_argument(
+        "--cache-dir",
+        help="Directory where snapshot queries are cached between runs. "
+             "(default: $XDG_CACHE_HOME/debrebuild)"
+    )
+    parser.add_argument(
+        "--keep-apt-cache",
+        help="Keep the APT cache in the cache directory between runs. "
+             "Snapshot indexes accumulate there and are never pruned, "
+             "remove its 'aptroot' sub directory to reclaim space.",
+        action="store_true"
+    )
     parser.add_argument(
         "--no-checksums-verification",
         help="Don't fail on checksums verification between original and"
@@ -794,58 +1161,166 @@ def get_args():
         action="store_true",
         help="Display logger debug messages."
     )
-    return parser.parse_args()
+    args = parser.parse_args()
 
+    if args.builder not in Rebuilder.BUILDERS:
+        parser.error("Unknown builder: {}".format(args.builder))
 
-def realpath(path):
-    return os.path.abspath(os.path.expanduser(path))
+    if Rebuilder.BUILDERS[args.builder] and not args.output:
+        parser.error(
+            "Output directory is required by builder: {}".format(args.builder))
 
+    if args.jobs < 1:
+        parser.error("Invalid number of jobs: {}".format(args.jobs))
 
-def main():
-    args = get_args()
+    if args.gpg_verify and not args.gpg_verify_key:
+        parser.error(
+            "Cannot verify buildinfo signature without GPG keyring provided")
+
+    return args
+
+
+def realpath(path):
+    if path.startswith('~'):
+        path = os.path.expanduser(path)
+    return os.path.abspath(path)
 
-    if args.debug:
+
+def configure_logging(debug=False, verbose=False):
+    if debug:
         logger.setLevel(logging.DEBUG)
-    elif args.verbose:
+    elif verbose:
         logger.setLevel(logging.INFO)
     else:
         logger.setLevel(logging.ERROR)
 
-    if args.builder not in ("none", "mmdebstrap"):
-        logger.error("Unknown builder: {}".format(args.builder))
-        return 1
-
-    if args.gpg_verify_key:
-        args.gpg_verify_key = realpath(args.gpg_verify_key)
 
-    if args.extra_repository_file:
-        args.extra_repository_file = \
-            [realpath(repo_file) for repo_file in args.extra_repository_file]
-
-    if args.extra_repository_key:
-        args.extra_repository_key = \
-            [realpath(key_file) for key_file in args.extra_repository_key]
+def rebuild(buildinfo_file, output=None, builder="none",
+            snapshot_url=DEFAULT_SNAPSHOT_URL,
+            no_checksums_verification=False, **kwargs):
+    """
+        Rebuild one buildinfo file without going through command line
+        parsing. Other keyword arguments are given to Rebuilder.
+    """
+    for key in ("gpg_verify_key", "cache_dir"):
+        if kwargs.get(key):
+            kwargs[key] = realpath(kwargs[key])
+    for key in ("extra_repository_files", "extra_repository_keys"):
+        if kwargs.get(key):
+            kwargs[key] = [realpath(path) for path in kwargs[key]]
+    if output:
+        output = realpath(output)
+
+    rebuilder = Rebuilder(
+        buildinfo_file=buildinfo_file, snapshot_url=snapshot_url, **kwargs)
+    rebuilder.run(builder=builder, output=output,
+                  no_checksums_verification=no_checksums_verification)
+
+
+def rebuild_task(task):
+    buildinfo_file, options = task
+    try:
+        rebuild(buildinfo_file, **options)
+    except (RebuilderException, BuildInfoException) as e:
+        return buildinfo_file, str(e)
+    except Exception as e:
+        # an unexpected failure must not stop the other rebuilds, its
+        # traceback is kept visible as it reveals a bug
+        logger.error("Unexpected error while rebuilding {}".format(
+            buildinfo_file), exc_info=True)
+        return buildinfo_file, "{}: {}".format(type(e).__name__, str(e))
+    return buildinfo_file, None
+
+
+def rebuild_task_in_worker(task):
+    try:
+        return rebuild_task(task)
+    finally:
+        # pool processes exit without running atexit hooks
+        _deleter.wait()
+
+
+def run_tasks(tasks, jobs=1, proxy=None):
+    """
+        Rebuild each task and return the list of (buildinfo_file, error)
+        for the failed ones.
+    """
+    failed = []
+    if jobs > 1 and len(tasks) > 1:
+        # A fresh process per task ensures no global APT configuration
+        # leaks from one rebuild to another. A persistent APT root shared
+        # between workers is serialized by its lock.
+        with multiprocessing.Pool(
+                processes=jobs, maxtasksperchild=1) as pool:
+            for result in pool.imap_unordered(rebuild_task_in_worker, tasks):
+                if result[1]:
+                    failed.append(result)
+    else:
+        # Sequential rebuilds reuse the connections of a single session
+        session = get_session(proxy)
+        try:
+            for buildinfo_file, options in tasks:
+                result = rebuild_task(
+                    (buildinfo_file, dict(options, session=session)))
+                if result[1]:
+                    failed.append(result)
+        finally:
+            session.close()
+    return failed
 
-    if args.gpg_verify and not args.gpg_verify_key:
-        logger.error(
-            "Cannot verify buildinfo signature without GPG keyring provided")
-        return 1
 
+def main():
+    args = get_args()
+    configure_logging(debug=args.debug, verbose=args.verbose)
+
+    options = {
+        "output": args.output,
+        "builder": args.builder,
+        "snapshot_url": args.query_url,
+        "no_checksums_verification": args.no_checksums_verification,
+        "extra_repository_files": args.extra_repository_file,
+        "extra_repository_keys": args.extra_repository_key,
+        "gpg_sign_keyid": args.gpg_sign_keyid,
+        "gpg_verify": args.gpg_verify,
+        "gpg_verify_key": args.gpg_verify_key,
+        "proxy": args.proxy,
+        "cache_dir": args.cache_dir,
+        "keep_aptcache": args.keep_apt_cache,
+    }
+    tasks = []
+    for buildinfo_file in args.buildinfo:
+        task_options = dict(options)
+        if args.output and len(args.buildinfo) > 1:
+            name = os.path.basename(buildinfo_file)
+            if name.endswith('.buildinfo'):
+                name = name[:-len('.buildinfo')]
+            task_options["output"] = os.path.join(args.output, name)
+            os.makedirs(task_options["output"], exist_ok=True)
+        tasks.append((buildinfo_file, task_options))
+
+    gpg_env = None
+    if args.gpg_verify:
+        # The verification key is imported once for every buildinfo file
+        gpg_env = OpenPGPEnvironment()
     try:
-        rebuilder = Rebuilder(
-            buildinfo_file=args.buildinfo,
-            snapshot_url=args.query_url,
-            extra_repository_files=args.extra_repository_file,
-            extra_repository_keys=args.extra_repository_key,
-            gpg_sign_keyid=args.gpg_sign_keyid,
-            gpg_verify=args.gpg_verify,
-            gpg_verify_key=args.gpg_verify_key,
-            proxy=args.proxy
-        )
-        rebuilder.run(builder=args.builder, output=realpath(args.output),
-                      no_checksums_verification=args.no_checksums_verification)
-    except RebuilderException as e:
-        logger.error(str(e))
+        if gpg_env:
+            try:
+                gpg_env.import_key(realpath(args.gpg_verify_key))
+            except (OSError, OpenPGPException) as e:
+                logger.error("Cannot import GPG key: {}".format(str(e)))
+                return 1
+            for task in tasks:
+                task[1]["gpg_env"] = gpg_env
+        failed = run_tasks(tasks, args.jobs, args.proxy)
+    finally:
+        if gpg_env:
+            gpg_env.close()
+
+    for buildinfo_file, error in failed:
+        if len(tasks) > 1:
+            error = "{}: {}".format(buildinfo_file, error)
+        logger.error(error)
+    if failed:
         return 1
 
 
@@ -159,10 +159,10 @@ debug-level guru
                 ownertrust)
 
     def verify_file(self, f):
-        with open(f, 'r') as fd:
+        with open(f, 'rb') as fd:
             exitst, out, err = self._spawn_gpg(
                 [GNUPG, '--batch', '--status-fd', '1', '--verify'],
-                fd.read().encode('utf8'))
+                fd.read())
 
         is_good = False
         is_trusted = False